@@ -0,0 +1,110 @@
+"""
+Micro-benchmark of the line screening step in scan.py: how many lines per
+second the prefix trie gets through, compared with the substring search it
+replaced. Runs on a real dump from scrape.py if one is named, otherwise on a
+synthetic dump written to a temporary file for the purpose.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+import scan
+
+SYNTHETIC_TRIALS = 2000         # trials in the synthetic dump
+MEMBER_STATES = 3               # listings of each trial, one per member state
+
+# Lines that scan.py captures, as they appear in a listing
+CAPTURED_LINES = ["Trial Status: Ongoing",
+                  "National Competent Authority: Germany - BfArM",
+                  "Date on which this record was first entered in the EudraCT database: 2012-05-01",
+                  "A.3 Full title of the trial: A randomised study of something against something else",
+                  "A.4.1 Sponsor's protocol code number: ABC-123",
+                  "B.1.1 Name of Sponsor: Acme GmbH",
+                  "B.5.1 Name of organisation: Acme GmbH",
+                  "B.5.6 E-mail: trials@acme.example",
+                  "D.IMP: 1",
+                  "D.2.1.1.1 Trade name: Acmezol",
+                  "D.3.1 Product name: Acmezol",
+                  "D.8.1 Is a Placebo used in this Trial? Yes",
+                  "E.1.1 Medical condition(s) being investigated: Hypertension",
+                  "E.1.2 Version: 20.0",
+                  "E.1.2 Level: PT",
+                  "E.7.2 Therapeutic exploratory (Phase II): Yes",
+                  "E.8.1.1 Randomised: Yes",
+                  "F.1.2 Adults (18-64 years): Yes",
+                  "F.4.2.2 In the whole clinical trial: 300",
+                  "P. Date of the global end of the trial: 2015-01-01"]
+
+# Lines that scan.py has no use for, which make up most of a listing
+IGNORED_LINES = ["E.2.1 Main objective of the trial: To compare the efficacy of the two treatments",
+                 "E.3 Principal inclusion criteria:",
+                 "E.4 Principal exclusion criteria:",
+                 "D.3.4 Pharmaceutical form: Film-coated tablet",
+                 "D.3.7 Routes of administration for this IMP: Oral use",
+                 "D.3.8 to D.3.10 IMP Identification Details (Active Substances)",
+                 "E.5.1 Primary end point(s): Change from baseline in systolic blood pressure",
+                 "Summary",
+                 "",
+                 "    1. Male or female patients aged 18 years or older",
+                 "    2. Written informed consent obtained before any study procedure",
+                 "    - Known hypersensitivity to the study drug or its excipients",
+                 "The trial will be conducted in accordance with Good Clinical Practice."]
+
+
+def synthetic_dump(filespec: str) -> None:
+    """
+    Write a listing with the same mix of captured and ignored lines as a scrape.py dump.
+    :param filespec: Name of the text file to write.
+    :return: None.
+    """
+    random.seed(0)
+    with open(filespec, "w", encoding="utf8") as out_file:
+        for trial_number in range(SYNTHETIC_TRIALS):
+            for _ in range(MEMBER_STATES):
+                print("EudraCT Number: 2012-{:06d}-42".format(trial_number), file=out_file)
+                for line in CAPTURED_LINES:
+                    print(line, file=out_file)
+                    for _ in range(random.randint(2, 12)):
+                        print(random.choice(IGNORED_LINES), file=out_file)
+
+
+def time_filter(lines: list, screen) -> tuple:
+    """
+    Run a screening function over every line.
+    :param lines: Lines of the listing.
+    :param screen: Function returning True for lines to keep.
+    :return: Number of lines kept, and lines screened per second.
+    """
+    start_time = time.perf_counter()
+    kept = sum(1 for line in lines if screen(line))
+    return kept, len(lines) / (time.perf_counter() - start_time)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        source_file = sys.argv[1]
+        with open(source_file, "r", encoding="utf8") as source:
+            listing = source.readlines()
+    else:
+        source_fd, source_file = tempfile.mkstemp(suffix=".txt")
+        os.close(source_fd)
+        try:
+            synthetic_dump(source_file)
+            with open(source_file, "r", encoding="utf8") as source:
+                listing = source.readlines()
+        finally:
+            os.remove(source_file)
+        source_file = "a synthetic dump"
+    print("Screening {} lines from {}".format(len(listing), source_file))
+
+    def substring_screen(line):
+        return any(screen_item in line for screen_item in scan.screening_list)
+
+    for name, screen_function in (("substring search", substring_screen),
+                                  ("prefix trie", scan.screening_trie.match)):
+        lines_kept, rate = time_filter(listing, screen_function)
+        print("{:>16}: kept {} lines, rejected {}, {:,.0f} lines/s"
+              .format(name, lines_kept, len(listing) - lines_kept, rate))
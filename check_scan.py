@@ -0,0 +1,79 @@
+"""
+Check how scan.py maps sponsor and location names to canonical entities:
+spellings of one organisation should share an entity, while organisations
+whose names differ only in a word or a number should not. Uses a throwaway
+database, so nothing existing is touched.
+"""
+
+import os
+import sqlite3
+import tempfile
+
+import scan
+
+# Each group lists spellings that should resolve to one entity; different groups must stay apart.
+SPONSOR_GROUPS = [["Centre Hospitalier Universitaire De Nantes",
+                   "Centre Hospitalier Universitaire De Nante"],            # a typo is absorbed
+                  ["Centre Hospitalier Universitaire De Nîmes",
+                   "Centre Hospitalier Universitaire De Nimes"],            # accents are folded
+                  ["Centre Hospitalier Universitaire De Nice"],
+                  ["Fundación Para La Investigación Biomédica Del Hospital Universitario La Paz",
+                   "Fundacion Para La Investigacion Biomedica Del Hospital Universitario La Paz"],
+                  ["Fundación Para La Investigación Biomédica Del Hospital Universitario La Princesa"],
+                  ["Charité - Universitätsmedizin Berlin",
+                   "Charite Universitatsmedizin Berlin"],
+                  ["Merck Kgaa"],
+                  ["Merck & Co., Inc.",
+                   "Merck & Co"],
+                  ["Acme GmbH",
+                   "Acme"]]
+
+LOCATION_GROUPS = [["Hospital Universitario 12 De Octubre",
+                    "Hospital Universitari 12 de Octubre."],
+                   ["Hospital Universitario 2 De Octubre"],
+                   ["United Kingdom",
+                    "UK",
+                    "United"],
+                   ["Czech Republic",
+                    "Czechia"]]
+
+
+def check_groups(db: sqlite3.Connection, lookup: scan.EntityLookup, groups: list) -> dict:
+    """
+    Resolve every name and check that the entities follow the groups.
+    :return: Name -> entity id.
+    """
+    entities = {}
+    for group in groups:
+        for name in group:
+            entities[name] = lookup.resolve(db, name)
+    for group in groups:
+        assert len({entities[x] for x in group}) == 1, [(x, entities[x]) for x in group]
+    first_of_each = [entities[group[0]] for group in groups]
+    assert len(set(first_of_each)) == len(groups), list(zip([x[0] for x in groups], first_of_each))
+    return entities
+
+
+if __name__ == "__main__":
+    database_fd, database_name = tempfile.mkstemp(suffix=".sqlite3")
+    os.close(database_fd)
+    os.remove(database_name)
+    try:
+        scan.create_databases(database_name)
+        with sqlite3.connect(database_name) as db:
+            results = []
+            for kind, column, key_function, groups in (("sponsor", "name", scan.sponsor_key, SPONSOR_GROUPS),
+                                                       ("location", "location", scan.location_key, LOCATION_GROUPS)):
+                lookup = scan.EntityLookup(kind, column, key_function)
+                lookup.load(db)
+                entities = check_groups(db, lookup, groups)
+                # a fresh lookup reading the stored tables must give the same answers
+                reloaded = scan.EntityLookup(kind, column, key_function)
+                reloaded.load(db)
+                reloaded.memo.clear()
+                assert check_groups(db, reloaded, groups) == entities
+                results.append("{} {} names in {} entities".format(len(entities), kind, len(groups)))
+        db.close()
+    finally:
+        os.remove(database_name)
+    print("Entity lookup behaved as expected: {}.".format("; ".join(results)))
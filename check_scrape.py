@@ -0,0 +1,89 @@
+"""
+Check the retry scheduler in scrape.py against a local web server that
+injects faults, without touching the registry itself. The backoff waits are
+recorded rather than slept, so the whole check takes a few seconds.
+"""
+
+import http.server
+import os
+import tempfile
+import threading
+
+import scrape
+
+TOP_PAGE = 10                   # pages the fake registry claims to have
+MAX_ATTEMPTS = 4                # tries per round, kept small so the check is quick
+MAX_SLEEP = 30                  # ceiling for waits, in seconds
+
+# Faults, by page number. Each page fails the given number of times, then serves its text.
+# A count of None means the page never comes good.
+FAULTS = {2: ("Status 503", 2),                 # busy, with a Retry-After of a day
+          4: ("Connection", 1),                 # connection dropped without a reply
+          6: ("Status 500", MAX_ATTEMPTS + 1),  # fails the main pass, recovers in quarantine
+          8: ("Status 500", None)}              # never recovers
+
+
+class FaultyRegistry(http.server.BaseHTTPRequestHandler):
+
+    hits = {}                                   # page number -> requests received
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if "page=" not in self.path:
+            self.reply(200, "Displaying page 1 of {} pages".format(TOP_PAGE))
+            return
+        page_number = int(self.path.split("page=")[1].split("&")[0])
+        self.hits[page_number] = self.hits.get(page_number, 0) + 1
+        fault, failures = FAULTS.get(page_number, ("", 0))
+        if failures is None or self.hits[page_number] <= failures:
+            if fault == "Connection":
+                self.close_connection = True
+            elif fault == "Status 503":
+                self.reply(503, "", {"Retry-After": "86400"})
+            else:
+                self.reply(500, "")
+            return
+        self.reply(200, "Text of page {}".format(page_number))
+
+    def reply(self, status: int, text: str, headers: dict = None) -> None:
+        self.send_response(status)
+        for header in headers or {}:
+            self.send_header(header, headers[header])
+        self.end_headers()
+        self.wfile.write(text.encode())
+
+
+if __name__ == "__main__":
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FaultyRegistry)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:{}".format(server.server_port)
+
+    waits = []
+    policy = scrape.RetryPolicy(max_attempts=MAX_ATTEMPTS, max_sleep=MAX_SLEEP, sleep=waits.append)
+    out_fd, out_file = tempfile.mkstemp(suffix=".txt")
+    os.close(out_fd)
+    try:
+        unrecovered = scrape.crawl(out_file, base_url + "/search?query=",
+                                   base_url + "/download?page={}&mode=current_page", policy)
+        with open(out_file, "r") as listing:
+            text = listing.read()
+    finally:
+        os.remove(out_file)
+        server.shutdown()
+
+    assert sorted(unrecovered) == [8], unrecovered
+    assert unrecovered[8].attempts == MAX_ATTEMPTS * (scrape.QUARANTINE_ROUNDS + 1), unrecovered[8].attempts
+    for page_number in range(1, TOP_PAGE + 1):
+        assert (("Text of page {}".format(page_number) in text) == (page_number != 8)), page_number
+    # the quarantined page is written after the main pass
+    assert text.index("Text of page 6") > text.index("Text of page {}".format(TOP_PAGE))
+    assert max(waits) <= MAX_SLEEP, max(waits)
+    assert waits.count(MAX_SLEEP) >= 2                  # the Retry-After of a day was held to the ceiling
+    # one wait after every failed try except the last of each round
+    failures = sum(FaultyRegistry.hits.values()) - (TOP_PAGE - 1)
+    # rounds that ended in failure: page 6's main pass, and page 8's main pass and every quarantine round
+    rounds = 1 + 1 + scrape.QUARANTINE_ROUNDS
+    assert len(waits) == failures - rounds, (len(waits), failures, rounds)
+    print("Retry scheduler behaved as expected over {} requests.".format(sum(FaultyRegistry.hits.values()) + 1))
@@ -8,6 +8,7 @@ exploration.
 import re
 import sqlite3
 import time
+import unicodedata
 
 
 class Element:
@@ -19,6 +20,262 @@ class Element:
         self.value = ""                                 # holds value read from source file
 
 
+class ScreeningTrie:
+
+    def __init__(self, prefixes):
+        self.root = {}                                  # character -> child node; None marks a complete prefix
+        for prefix in prefixes:
+            node = self.root
+            for character in prefix:
+                node = node.setdefault(character, {})
+            node[None] = True
+
+    def match(self, line: str) -> bool:
+        """
+        Whether the line, ignoring leading white space, starts with one of the prefixes.
+        Most lines are turned away within their first one or two characters.
+        :param line: A line from the text listing of trials.
+        :return: True if the line is worth testing against the regular expressions.
+        """
+        node = self.root
+        for character in line.lstrip():
+            node = node.get(character)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+class EntityLookup:
+
+    def __init__(self, kind: str, column: str, key_function):
+        self.kind = kind                                # table prefix, e.g. "sponsor" -> sponsor_entity
+        self.column = column                            # column of the kind's table holding the raw name
+        self.key_function = key_function                # reduces a raw name to a comparison key
+        self.overrides = {}                             # raw name -> key, set by hand to correct a bad match
+        self.memo = {}                                  # raw name -> entity id, seeded from the alias table
+        self.keys = {}                                  # comparison key -> entity id
+        self.buckets = {}                               # (first letter, numbers, words) of key -> keys to fuzzy-match
+
+    def load(self, db: sqlite3.Connection) -> None:
+        """
+        Read the persistent lookup tables into memory so that names seen on an earlier
+        run resolve to the same entities.
+        :param db: The database connection.
+        :return: None.
+        """
+        self.overrides.clear()
+        self.memo.clear()
+        self.keys.clear()
+        self.buckets.clear()
+        for entity_id, key in db.execute("SELECT entity_id, match_key FROM {}_entity".format(self.kind)):
+            self.keys[key] = entity_id
+            self.buckets.setdefault(bucket_of(key), []).append(key)
+        for key, entity_id in db.execute("SELECT match_key, entity_id FROM {}_key".format(self.kind)):
+            self.keys[key] = entity_id
+        for alias, entity_id in db.execute("SELECT alias, entity_id FROM {}_alias".format(self.kind)):
+            self.memo[alias] = entity_id
+        for alias, key in db.execute("SELECT alias, match_key FROM {}_override".format(self.kind)):
+            self.overrides[alias] = key
+            # forget the remembered match so that the override takes effect
+            self.memo.pop(alias, None)
+
+    def apply_overrides(self, db: sqlite3.Connection) -> None:
+        """
+        Move rows whose name has an override onto the entity the override points to.
+        A wrong merge can thus be undone by adding a row to the override table and
+        parsing again, without touching the code.
+        :param db: The database connection.
+        :return: None.
+        """
+        for alias in self.overrides:
+            db.execute("UPDATE {} SET entity_id = ? WHERE {} = ?".format(self.kind, self.column),
+                       (self.resolve(db, alias), alias))
+
+    def backfill(self, db: sqlite3.Connection) -> None:
+        """
+        Resolve the rows that have no entity yet, i.e. those written before names
+        were normalized, so that older databases group correctly without a full re-parse.
+        :param db: The database connection.
+        :return: None.
+        """
+        missing = db.execute("SELECT DISTINCT {} FROM {} WHERE entity_id IS NULL"
+                             .format(self.column, self.kind)).fetchall()
+        if missing:
+            print("Assigning entities to {} {} names".format(len(missing), self.kind))
+        for name, in missing:
+            db.execute("UPDATE {} SET entity_id = ? WHERE {} = ? AND entity_id IS NULL".format(self.kind, self.column),
+                       (self.resolve(db, name), name))
+
+    def resolve(self, db: sqlite3.Connection, name: str):
+        """
+        Map a name to its canonical entity. An exact match on the comparison key is
+        tried first, then a fuzzy match (see fuzzy_match), and only then is a new entity
+        created. A name with an override takes the key given there and is never
+        fuzzy-matched. Every spelling met is remembered as an alias.
+        :param db: The database connection.
+        :param name: The name as written in the registry.
+        :return: The entity id, or None if the name is blank.
+        """
+        if name in self.memo:
+            return self.memo[name]
+        key = self.overrides.get(name) or self.key_function(name)
+        if not key:
+            self.memo[name] = None
+            return None
+        if key in self.keys:
+            entity_id = self.keys[key]
+        else:
+            close = "" if name in self.overrides else fuzzy_match(key, self.buckets.get(bucket_of(key), []))
+            if close:
+                entity_id = self.keys[close]
+                print("Matched {} name '{}' to '{}'".format(self.kind, key, close))
+                # fuzzy matches are kept out of the buckets so that a chain of near misses cannot
+                # drift, but are stored so that the key resolves the same way on later runs
+                db.execute("INSERT OR REPLACE INTO {}_key(match_key, entity_id) VALUES(?,?)".format(self.kind),
+                           (key, entity_id))
+            else:
+                entity_id = db.execute("INSERT INTO {}_entity(name, match_key) VALUES(?,?)".format(self.kind),
+                                       (name, key)).lastrowid
+                self.buckets.setdefault(bucket_of(key), []).append(key)
+            self.keys[key] = entity_id
+        db.execute("INSERT OR REPLACE INTO {}_alias(alias, entity_id) VALUES(?,?)".format(self.kind),
+                   (name, entity_id))
+        self.memo[name] = entity_id
+        return entity_id
+
+
+def bucket_of(key: str) -> tuple:
+    """
+    The group of keys a key may be fuzzy-matched against: those with the same first
+    letter, the same sequence of numbers and the same number of words, so that e.g.
+    "Hospital 12 de Octubre" cannot join "Hospital 2 de Octubre".
+    :param key: A comparison key.
+    :return: The bucket.
+    """
+    return key[0], tuple(re.findall(r"\d+", key)), key.count(" ")
+
+
+def word_edits(word: str, other_word: str, limit: int) -> int:
+    """
+    Levenshtein distance between two words, giving up once it exceeds the limit.
+    :param word: A word.
+    :param other_word: The word to compare it with.
+    :param limit: Largest distance of interest.
+    :return: The distance, or limit + 1 if it is larger than the limit.
+    """
+    if abs(len(word) - len(other_word)) > limit:
+        return limit + 1
+    previous = list(range(len(other_word) + 1))
+    for i, character in enumerate(word, 1):
+        current = [i]
+        for j, other_character in enumerate(other_word, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (character != other_character)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def fuzzy_match(key: str, candidates: list) -> str:
+    """
+    Find the candidate that is a misspelling of the key. Words are compared pair by pair,
+    each allowed one edit, or two in words of LONG_WORD letters or more, so a typo can
+    be absorbed but a different word cannot: "... de Nantes" does not join "... de Nimes",
+    nor "... La Paz" "... La Princesa", however long the rest of the name.
+    :param key: A comparison key with no exact match.
+    :param candidates: Keys from the same bucket, i.e. with as many words as the key.
+    :return: The candidate needing fewest edits, or "" if none is close enough.
+    """
+    words = key.split()
+    best, best_edits = "", None
+    for candidate in candidates:
+        edits = 0
+        for word, other_word in zip(words, candidate.split()):
+            limit = 2 if len(word) >= LONG_WORD else 1
+            distance = word_edits(word, other_word, limit)
+            if distance > limit:
+                break
+            edits += distance
+        else:
+            if best_edits is None or edits < best_edits:
+                best, best_edits = candidate, edits
+    return best
+
+
+def name_key(name: str) -> list:
+    """
+    Break a name into casefolded words with accents and punctuation removed, so that
+    e.g. "Charité" and "Charite" give the same words. Full stops are dropped rather than
+    spaced so that abbreviations like "S.A." stay one word.
+    :param name: A name as written in the registry.
+    :return: List of words.
+    """
+    folded = "".join(x for x in unicodedata.normalize("NFKD", name.casefold()) if not unicodedata.combining(x))
+    return re.sub(r"[^\w\s]", " ", folded.replace(".", "")).split()
+
+
+def sponsor_key(name: str) -> str:
+    """
+    Comparison key for a sponsor: the name without punctuation, a leading "the",
+    or trailing legal forms such as GmbH or Ltd. Forms that can tell two companies
+    apart, e.g. Merck KGaA and Merck & Co., are kept.
+    :param name: The sponsor name.
+    :return: The key.
+    """
+    words = name_key(name)
+    if words and words[0] == "the":
+        words.pop(0)
+    while len(words) > 1 and words[-1] in LEGAL_FORMS:
+        words.pop()
+    return " ".join(words)
+
+
+def location_key(name: str) -> str:
+    """
+    Comparison key for a location, folding common alternative country names together.
+    :param name: The location.
+    :return: The key.
+    """
+    key = " ".join(name_key(name))
+    return COUNTRY_ALIASES.get(key, key)
+
+
+def create_entity_tables(db: sqlite3.Connection) -> None:
+    """
+    Create the canonical entity, key, alias and override tables, if they do not exist yet, and add the
+    entity_id column to sponsor and location tables written before normalization was introduced.
+    :param db: The database connection.
+    :return: None.
+    """
+    for kind in ("sponsor", "location"):
+        db.execute("CREATE TABLE IF NOT EXISTS {}_entity(\n"
+                   "entity_id INTEGER PRIMARY KEY,\n"
+                   "name TEXT NOT NULL,\n"
+                   "match_key TEXT NOT NULL UNIQUE\n"
+                   ")".format(kind))
+        # comparison keys that joined an entity by fuzzy match
+        db.execute("CREATE TABLE IF NOT EXISTS {}_key(\n"
+                   "match_key TEXT NOT NULL PRIMARY KEY,\n"
+                   "entity_id INTEGER NOT NULL\n"
+                   ")".format(kind))
+        db.execute("CREATE TABLE IF NOT EXISTS {}_alias(\n"
+                   "alias TEXT NOT NULL PRIMARY KEY,\n"
+                   "entity_id INTEGER NOT NULL\n"
+                   ")".format(kind))
+        # filled by hand: the key a given spelling should be matched under
+        db.execute("CREATE TABLE IF NOT EXISTS {}_override(\n"
+                   "alias TEXT NOT NULL PRIMARY KEY,\n"
+                   "match_key TEXT NOT NULL\n"
+                   ")".format(kind))
+        if "entity_id" not in [x[1] for x in db.execute("PRAGMA table_info({})".format(kind))]:
+            db.execute("ALTER TABLE {} ADD COLUMN entity_id INTEGER".format(kind))
+        db.execute("CREATE INDEX IF NOT EXISTS idx_{0}_entity on {0} (entity_id)".format(kind))
+        db.execute("CREATE INDEX IF NOT EXISTS idx_{0}_alias_entity on {0}_alias (entity_id)".format(kind))
+
+
 def wipe_dict(target: dict) -> None:
     """
     Sets the value of a dictionary element to "". Called by wipe_all.
@@ -60,12 +317,14 @@ def create_databases(filespec: str) -> None:
 
         db_sponsor_def = "CREATE TABLE sponsor(\n" \
                          "eudract_id TEXT NOT NULL," \
-                         "\n{}\n" \
+                         "\n{},\n" \
+                         "entity_id INTEGER\n" \
                          ")"
 
         db_location_def = "CREATE TABLE location(\n" \
                           "eudract_id TEXT NOT NULL,\n" \
-                          "location TEXT NOT NULL\n" \
+                          "location TEXT NOT NULL,\n" \
+                          "entity_id INTEGER\n" \
                           ")"
 
         db_location_index = "CREATE INDEX idx_location on location (eudract_id)"
@@ -82,6 +341,7 @@ def create_databases(filespec: str) -> None:
         db.execute(db_location_index)
         db.execute(db_sponsor_index)
         db.execute(db_imp_index)
+        create_entity_tables(db)
         print("databases created!")
     db.close()
 
@@ -190,13 +450,17 @@ def update_imp(db: sqlite3.Connection, list_of_imps) -> None:
 
 def update_sponsor(db: sqlite3.Connection) -> None:
     """
-    Write the sponsor-related data for a given trial to the database.
+    Write the sponsor-related data for a given trial to the database, along with
+    the canonical entity for each sponsor name.
     :return: None.
     """
-    tup_to_db(db, "sponsor", sponsor, sponsor_set)
+    name_position = sorted(sponsor).index("name")
+    tup_to_db(db, "sponsor", sponsor,
+              [details + (sponsor_lookup.resolve(db, details[name_position]),) for details in sponsor_set],
+              ["entity_id"])
 
 
-def tup_to_db(db: sqlite3.Connection, tup_name: str, tup_dict: dict, tups) -> None:
+def tup_to_db(db: sqlite3.Connection, tup_name: str, tup_dict: dict, tups, extra_columns=()) -> None:
     """
     Helper function that takes care of database writing for update_sponsor
     and update_imp.
@@ -205,15 +469,18 @@ def tup_to_db(db: sqlite3.Connection, tup_name: str, tup_dict: dict, tups) -> No
     :param tup_dict: the dictionary itself
     :param tups: a tuple from the collection, either the list of IMPs or
     the set of sponsors.
+    :param extra_columns: names of columns, not in the dictionary, whose values
+    follow the dictionary values at the end of each tuple.
     :return: None.
     """
     add_tup_stmt = "INSERT INTO {}({})\nVALUES({})"
+    columns = sorted(tup_dict) + list(extra_columns)
     for details in tups:
         temp = list(details)
         temp.insert(0, trial["eudract_id"].value)
         db.execute(add_tup_stmt.format(tup_name,
-                                       "\neudract_id,\n" + ",\n".join(sorted(tup_dict)),
-                                       ",".join("?" * (len(tup_dict) + 1))),
+                                       "\neudract_id,\n" + ",\n".join(columns),
+                                       ",".join("?" * (len(columns) + 1))),
                    tuple(temp))
 
 
@@ -222,10 +489,11 @@ def update_location(db: sqlite3.Connection) -> None:
     Write the location-related data about a trial to the database.
     :return: None.
     """
-    add_location_stmt = "INSERT INTO location(eudract_id, location)\nVALUES(?,?)"
+    add_location_stmt = "INSERT INTO location(eudract_id, location, entity_id)\nVALUES(?,?,?)"
     for where in sorted(location_set):
         db.execute(add_location_stmt, (trial["eudract_id"].value,
-                                       where))
+                                       where,
+                                       location_lookup.resolve(db, where)))
 
 
 def add_imp_to_list() -> None:
@@ -260,9 +528,20 @@ def empty_dict(query_dict: dict) -> bool:
     return True
 
 
-def update_databases(filespec: str) -> None:
+def remove_trial(db: sqlite3.Connection) -> None:
+    """
+    Delete every row held for the current trial so that a fresh copy can be written in its place.
+    :return: None.
+    """
+    for table in ("trial", "imp", "sponsor", "location"):
+        db.execute("DELETE FROM {} WHERE eudract_id = ?".format(table), (trial["eudract_id"].value,))
+
+
+def update_databases(filespec: str, refresh: bool = False) -> None:
     """
     Calls subroutines to write data to each table of database.
+    :param filespec: The database file.
+    :param refresh: Replace any rows already held for the trial rather than adding to them.
     :return:
     """
     # Add uncommitted items to their respective lists
@@ -270,6 +549,8 @@ def update_databases(filespec: str) -> None:
         if not empty_dict(imp):
             add_imp_to_list()
         add_sponsor_to_set()
+        if refresh:
+            remove_trial(conn)
         # Update each database table
         update_trial(conn)
         update_imp(conn, imp_list)
@@ -327,13 +608,32 @@ def list_match(current_line: str, test_item: Element) -> str:
         return ""
 
 
-def parse_listing(infile: str, outfile: str):
+def parse_listing(infile: str, outfile: str, refresh: bool = False):
+    """
+    Reads a text listing of trials and writes each trial to the database.
+    :param infile: The text listing, as written by scrape.py.
+    :param outfile: The database file.
+    :param refresh: Update trials already in the database instead of adding new ones only.
+    :return: None.
+    """
     current_trial = ""
     print("Parsing.")
+    # Start clean in case an earlier listing was parsed in the same run
+    wipe_all()
+    # Bring in the canonical names already known so that entity ids stay stable between runs
+    with sqlite3.connect(outfile) as db:
+        create_entity_tables(db)
+        sponsor_lookup.load(db)
+        location_lookup.load(db)
+        sponsor_lookup.apply_overrides(db)
+        location_lookup.apply_overrides(db)
+        sponsor_lookup.backfill(db)
+        location_lookup.backfill(db)
+    db.close()
     with open(infile, "r", encoding='utf8') as eu_trials:
         line = eu_trials.readline()
         while line:
-            if not any(screen_item in line for screen_item in screening_list):
+            if not screening_trie.match(line):
                 line = eu_trials.readline()
                 continue
             # For each line, try to match all elements to be captured.
@@ -344,7 +644,7 @@ def parse_listing(infile: str, outfile: str):
                 if current_trial != tested_term:
                     if trial["eudract_id"].value != "":
                         # write to database tables
-                        update_databases(outfile)
+                        update_databases(outfile, refresh)
                     # Capture the new Eudract number for next trial
                     wipe_all()
                     trial["eudract_id"].value = current_trial = tested_term
@@ -404,7 +704,8 @@ def parse_listing(infile: str, outfile: str):
             # Future expansion: add any new elements here
             line = eu_trials.readline()
         # Flush last record
-        update_databases(outfile)
+        if trial["eudract_id"].value != "":
+            update_databases(outfile, refresh)
 
 
 # Trial dictionary definitions
@@ -474,26 +775,54 @@ sponsor = {"name": Element("TEXT NOT NULL", "^B.1.1 Name of Sponsor: (.*$)"),
 
 # Other regexp definitions for precompiling:
 other = {"imp_re": Element("", r"D.IMP: \d+"),
-         "loc_re": Element("", r"^National Competent Authority:\s+(\S*)\s+[-]"),
+         "loc_re": Element("", r"^National Competent Authority:\s+(.*?)\s+[-]"),
          "loc_start_re": Element("", "^E.8.6.3 If E.8.6.1 or E.8.6.2 are Yes"),
          "loc_end_re": Element("", "^E.8.7 Trial has a data monitoring committee"),
          "loc_alt_start_re": Element("", "^E.8.6.3 Specify the countries outside of the EEA"),
          "loc_alt_end_re": Element("", "^E.8.7 Trial has a data monitoring committee:")
          }
 
-if __name__ == "__main__":
-    # Sets are used for sponsor and location to consolidate repeating data
-    imp_list = []
-    sponsor_set = set()
-    location_set = set()
-
-    # compile a screening list - when parsing, will skip any line without one of these phrases
-    screening_list = []
-    for dictionary in (trial, imp, sponsor, other):
-        for dict_idx in dictionary:
-            # first seven characters of each line after removing the regex start of line anchor
-            screening_list.append(dictionary[dict_idx].regdef[:7].strip("^"))
+# Normalization of sponsor and location names to canonical entities
+LONG_WORD = 8           # letters from which a word may differ by two edits in a fuzzy match, rather than one
+
+# Only forms that do not distinguish one company from another: Co, KGaA and the like are left in the key
+LEGAL_FORMS = {"ag", "bv", "corp", "corporation", "gmbh", "inc", "incorporated", "limited", "llc", "ltd",
+               "nv", "oy", "oyj", "plc", "sa", "sarl", "sas", "spa", "srl", "sro"}
+
+COUNTRY_ALIASES = {"uk": "united kingdom",
+                   "great britain": "united kingdom",
+                   "england": "united kingdom",
+                   "usa": "united states",
+                   "us": "united states",
+                   "united states of america": "united states",
+                   "russia": "russian federation",
+                   "south korea": "korea republic of",
+                   "republic of korea": "korea republic of",
+                   "czechia": "czech republic",
+                   "holland": "netherlands",
+                   "the netherlands": "netherlands",
+                   # first word only, as stored for member states by databases parsed before the
+                   # National Competent Authority line was read in full
+                   "czech": "czech republic",
+                   "united": "united kingdom"}
+
+sponsor_lookup = EntityLookup("sponsor", "name", sponsor_key)
+location_lookup = EntityLookup("location", "location", location_key)
+
+# Sets are used for sponsor and location to consolidate repeating data
+imp_list = []
+sponsor_set = set()
+location_set = set()
+
+# compile a screening list - when parsing, will skip any line that does not start with one of these phrases
+screening_list = []
+for dictionary in (trial, imp, sponsor, other):
+    for dict_idx in dictionary:
+        # first seven characters of each line after removing the regex start of line anchor
+        screening_list.append(dictionary[dict_idx].regdef[:7].strip("^"))
+screening_trie = ScreeningTrie(screening_list)
 
+if __name__ == "__main__":
     # source_file = "20210826-1644.txt"
     source_file = input("Name of source file to parse? >")
     database_name = input("Name of database to write? > ")
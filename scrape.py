@@ -3,67 +3,340 @@ Download every trial publicly listed on the EU Clinical trial register,
 page by page as a huge text file.
 """
 
+import email.utils
+import math
+import random
 import requests
+import sqlite3
+import sys
 import time
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 import re
 
+import scan
+
 # To not have to deal with the SSL connection, certs, etc.
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 HOW_MANY_PAGES_URL = "https://www.clinicaltrialsregister.eu/ctr-search/search?query="
 PAGES_URL = "https://www.clinicaltrialsregister.eu/ctr-search/rest/download/full?query=&page={}&mode=current_page"
+# The summary download documented in magicString.txt only lists headline fields, so ask for the full text instead.
+SELECTED_URL = "https://www.clinicaltrialsregister.eu/ctr-search/rest/download/full?mode=selected&eudracts={}"
+
+MAX_SLEEP = 600             # ceiling, in seconds, for the exponential backoff
+MAX_ATTEMPTS = 8            # tries per round before a page is set aside in quarantine
+QUARANTINE_ROUNDS = 3       # passes over the quarantined pages once the main crawl is done
+REPORT_EVERY = 100          # pages between crawl-health reports
+BATCH_SIZE = 50             # EudraCT numbers requested at a time when refreshing selected trials
+
+
+class PageAttempt:
+
+    def __init__(self, url: str):
+        self.url = url                                  # address of the page
+        self.attempts = 0                               # failed tries so far, across all rounds
+        self.last_error = ""                            # description of the most recent failure
+
+
+class RetryPolicy:
+
+    def __init__(self, max_attempts: int = MAX_ATTEMPTS, max_sleep: float = MAX_SLEEP,
+                 sleep=time.sleep, jitter=random.uniform):
+        self.max_attempts = max_attempts                # tries per round before a page is quarantined
+        self.max_sleep = max_sleep                      # ceiling, in seconds, for any wait
+        self.sleep = sleep                              # called with the seconds to wait
+        self.jitter = jitter                            # called as jitter(low, high) to pick a backoff
+
+
+class CrawlHealth:
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.latencies = []                             # seconds per successful request
+        self.requests = 0                               # every request made, good or bad
+        self.errors = {}                                # error description -> count
+        self.pages = 0                                  # pages successfully written
+
+    def record_success(self, latency: float) -> None:
+        self.requests += 1
+        self.latencies.append(latency)
+
+    def record_error(self, error_type: str) -> None:
+        self.requests += 1
+        self.errors[error_type] = self.errors.get(error_type, 0) + 1
+
+    def percentile(self, pct: float) -> float:
+        """
+        Nearest-rank percentile of the request latencies.
+        :param pct: Percentile wanted, 0-100.
+        :return: Latency in seconds, or 0 if nothing has been timed yet.
+        """
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+        return ordered[rank]
+
+    def error_rate(self) -> float:
+        if not self.requests:
+            return 0.0
+        return sum(self.errors.values()) / self.requests
+
+    def pages_per_minute(self) -> float:
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.pages / elapsed * 60
+
+    def report(self) -> str:
+        summary = "Health: {} pages, {:.1f} pages/min, latency p50 {:.2f}s p90 {:.2f}s p99 {:.2f}s, " \
+                  "error rate {:.1%}".format(self.pages, self.pages_per_minute(), self.percentile(50),
+                                             self.percentile(90), self.percentile(99), self.error_rate())
+        if self.errors:
+            summary += " ({})".format(", ".join("{}: {}".format(x, self.errors[x]) for x in sorted(self.errors)))
+        return summary
+
+
+def backoff_delay(attempts: int, policy: RetryPolicy) -> float:
+    """
+    Exponential backoff with full jitter: a random wait between zero and
+    2^attempts seconds, capped at the policy's max_sleep. The jitter keeps retries
+    from hammering the server in lockstep.
+    :param attempts: Number of failures so far for the page.
+    :param policy: Retry settings.
+    :return: Seconds to wait.
+    """
+    return policy.jitter(0, min(policy.max_sleep, 2 ** attempts))
+
+
+def retry_after_delay(page: requests.Response) -> float:
+    """
+    Reads the Retry-After header, which may be given either as a number of
+    seconds or as an HTTP date.
+    :param page: The response carrying the header.
+    :return: Seconds the server asked us to wait, or 0 if it did not say.
+    """
+    header = page.headers.get("Retry-After", "").strip()
+    if not header:
+        return 0.0
+    if header.isdigit():
+        return float(header)
+    try:
+        when = email.utils.parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return 0.0
+    return max(0.0, when.timestamp() - time.time())
 
 
-def sleep_on_error(error_type: str, sleep_duration: int) -> int:
-    print("{} Error. Resetting after {} seconds".format(error_type, sleep_duration))
-    time.sleep(sleep_duration)
-    if sleep_duration < 600:
-        sleep_duration *= 2
-    return sleep_duration
+def record_failure(error_type: str, attempt: PageAttempt, health: CrawlHealth) -> None:
+    """
+    Records a failure against the page and the crawl.
+    :return: None.
+    """
+    attempt.attempts += 1
+    attempt.last_error = error_type
+    health.record_error(error_type)
 
 
-def access_page(url_string: str) -> requests.Response:
-    sleep_time = 1
-    read_again = True
-    page = None
-    while read_again:
+def sleep_on_error(error_type: str, attempt: PageAttempt, policy: RetryPolicy, retry_after: float = 0.0) -> None:
+    """
+    Waits before the next try. The wait is the jittered backoff or the server's
+    Retry-After, whichever is longer, but never more than the policy's max_sleep: a
+    server asking for a longer pause would otherwise stall the whole crawl. The page
+    is quarantined instead if it is still failing at the end of the round.
+    :return: None.
+    """
+    sleep_duration = min(policy.max_sleep, max(backoff_delay(attempt.attempts, policy), retry_after))
+    print("{} Error. Resetting after {:.1f} seconds".format(error_type, sleep_duration))
+    policy.sleep(sleep_duration)
+
+
+def access_page(attempt: PageAttempt, health: CrawlHealth, policy: RetryPolicy):
+    """
+    Fetches a page, retrying on time outs, connection errors and bad status codes.
+    :param attempt: Retry state for the page, carried over between rounds.
+    :param health: Crawl-health tally.
+    :param policy: Retry settings, including the tries allowed in this round.
+    :return: The response, or None if every try in this round failed.
+    """
+    for try_number in range(1, policy.max_attempts + 1):
+        retry_after = 0.0
+        request_start = time.time()
         try:
             # timeout parameters: time to connect, time to begin reading response
-            page = requests.get(url_string, verify=False, timeout=(2, 5))
+            page = requests.get(attempt.url, verify=False, timeout=(2, 5))
         except requests.exceptions.Timeout:
-            sleep_time = sleep_on_error("Time Out", sleep_time)
+            error_type = "Time Out"
         except requests.exceptions.ConnectionError:
-            sleep_time = sleep_on_error("Connection", sleep_time)
+            error_type = "Connection"
         else:
-            if page.status_code != 200:
-                sleep_on_error("Status {}".format(page.status_code), sleep_time)
+            if page.status_code == 200:
+                health.record_success(time.time() - request_start)
+                return page
+            error_type = "Status {}".format(page.status_code)
+            retry_after = retry_after_delay(page)
+        record_failure(error_type, attempt, health)
+        # no point waiting after the last try of the round
+        if try_number < policy.max_attempts:
+            sleep_on_error(error_type, attempt, policy, retry_after)
+    return None
+
+
+def find_top_page(how_many_url: str, health: CrawlHealth, policy: RetryPolicy) -> int:
+    """
+    Reads the search results page to find out how many pages there are to crawl.
+    :return: One past the number of the last page.
+    """
+    max_re = re.compile(r".*Displaying page 1 of ([0-9,]+).*")
+    page = access_page(PageAttempt(how_many_url), health, policy)
+    if page is not None:
+        for line in page.text.splitlines():
+            m = max_re.match(line)
+            if m:
+                top_page = int("".join(m.group(1).split(","))) + 1
+                print("Top Page is {}".format(top_page))
+                return top_page
+    raise Exception("Unable to determine last page of site to crawl.")
+
+
+def write_page(page_number: int, page: requests.Response, out_file, health: CrawlHealth) -> None:
+    print("### PAGE {} ####".format(page_number), file=out_file)
+    print(page.text, file=out_file)
+    health.pages += 1
+    if health.pages % REPORT_EVERY == 0:
+        print(health.report())
+
+
+def crawl(filespec: str, how_many_url: str = HOW_MANY_PAGES_URL, pages_url: str = PAGES_URL,
+          policy: RetryPolicy = None) -> dict:
+    """
+    Downloads every page of the registry into one text file. A page that keeps
+    failing is quarantined so that it does not hold up the rest of the crawl, and
+    is retried once the main pass is done. Quarantined pages therefore end up out
+    of order at the end of the file, each still under its own page marker. The
+    URLs and retry settings are parameters so that the crawler can be pointed at a
+    local test server without waiting out real backoffs (see check_scrape.py).
+    :param filespec: Name of the text file to write.
+    :param policy: Retry settings; the defaults if not given.
+    :return: Pages that could not be downloaded at all, page number -> PageAttempt.
+    """
+    policy = policy or RetryPolicy()
+    health = CrawlHealth()
+    top_page = find_top_page(how_many_url, health, policy)
+    quarantine = {}
+
+    with open(filespec, "w") as out_file:
+        for page_number in range(1, top_page):
+            print("Accessing page {}".format(page_number))
+            attempt = PageAttempt(pages_url.format(page_number))
+            page = access_page(attempt, health, policy)
+            if page is None:
+                print("Quarantining page {} after {} attempts ({})"
+                      .format(page_number, attempt.attempts, attempt.last_error))
+                quarantine[page_number] = attempt
             else:
-                read_again = False
-    return page
+                write_page(page_number, page, out_file, health)
 
+        retry_quarantine(quarantine, out_file, health, policy)
 
-max_re = re.compile(r".*Displaying page 1 of ([0-9,]+).*")
+    print(health.report())
+    if quarantine:
+        print("Unable to download pages: {}".format(", ".join(str(x) for x in sorted(quarantine))))
+    return quarantine
 
-top_page = 1
-start_time = time.time()
-filespec = time.strftime("%Y%m%d-%H%M")
 
-print("Executing")
+def retry_quarantine(quarantine: dict, out_file, health: CrawlHealth, policy: RetryPolicy) -> None:
+    """
+    Makes further passes over the quarantined pages, appending any that now
+    download to the output file and dropping them from the quarantine.
+    :param quarantine: Page number -> PageAttempt; updated in place.
+    :return: None.
+    """
+    for quarantine_round in range(1, QUARANTINE_ROUNDS + 1):
+        if not quarantine:
+            break
+        print("Quarantine round {}: retrying {} pages".format(quarantine_round, len(quarantine)))
+        for page_number in sorted(quarantine):
+            page = access_page(quarantine[page_number], health, policy)
+            if page is not None:
+                write_page(page_number, page, out_file, health)
+                del quarantine[page_number]
 
-for line in access_page(HOW_MANY_PAGES_URL).text.splitlines():
-    m = max_re.match(line)
-    if m:
-        top_page = int("".join(m.group(1).split(","))) + 1
-        print("Top Page is {}".format(top_page))
-        break
-if top_page == 1:
-    raise Exception("Unable to determine last page of site to crawl.")
 
-with open(filespec, "w") as test_file:
-    for page_number in range(1, top_page):
-        print("Accessing page {}".format(page_number))
-        print("### PAGE {} ####".format(page_number), file=test_file)
-        print(access_page(PAGES_URL.format(page_number)).text, file=test_file)
+def ongoing_trials(database: str) -> list:
+    """
+    Lists the trials that the database still records as ongoing.
+    :param database: The database file.
+    :return: EudraCT numbers.
+    """
+    with sqlite3.connect(database) as db:
+        rows = db.execute("SELECT eudract_id FROM trial WHERE overall_status = 'ongoing'").fetchall()
+    db.close()
+    return [x[0] for x in rows]
 
-print("Done. Elapsed time {0:.2f} minutes.".format((time.time() - start_time) / 60))
+
+def read_trial_list(filespec: str) -> list:
+    """
+    Reads EudraCT numbers from a text file, one or more per line separated by
+    commas or white space.
+    :param filespec: The text file.
+    :return: EudraCT numbers.
+    """
+    with open(filespec, "r") as id_file:
+        return id_file.read().replace(",", " ").split()
+
+
+def refresh(eudract_ids: list, database: str, filespec: str, selected_url: str = SELECTED_URL,
+            policy: RetryPolicy = None) -> dict:
+    """
+    Downloads just the listed trials, in batches, and writes them over the copies
+    already held in the database. Batches that cannot be downloaded are quarantined
+    and retried in the same way as pages of a full crawl.
+    :param eudract_ids: EudraCT numbers of the trials to refresh.
+    :param database: An existing database written by scan.py.
+    :param filespec: Name of the text file to hold the downloaded listing.
+    :param policy: Retry settings; the defaults if not given.
+    :return: Batches that could not be downloaded at all, batch number -> PageAttempt.
+    """
+    policy = policy or RetryPolicy()
+    health = CrawlHealth()
+    quarantine = {}
+    batches = [eudract_ids[x:x + BATCH_SIZE] for x in range(0, len(eudract_ids), BATCH_SIZE)]
+
+    with open(filespec, "w") as out_file:
+        for batch_number, batch in enumerate(batches, 1):
+            print("Accessing batch {} of {}".format(batch_number, len(batches)))
+            attempt = PageAttempt(selected_url.format(",".join(batch)))
+            page = access_page(attempt, health, policy)
+            if page is None:
+                print("Quarantining batch {} after {} attempts ({})"
+                      .format(batch_number, attempt.attempts, attempt.last_error))
+                quarantine[batch_number] = attempt
+            else:
+                write_page(batch_number, page, out_file, health)
+
+        retry_quarantine(quarantine, out_file, health, policy)
+
+    print(health.report())
+    if quarantine:
+        print("Unable to download trials: {}"
+              .format(", ".join(", ".join(batches[x - 1]) for x in sorted(quarantine))))
+    scan.parse_listing(filespec, database, refresh=True)
+    return quarantine
+
+
+if __name__ == "__main__":
+    # With no arguments, crawl the whole registry. To refresh trials already in a database:
+    #   scrape.py refresh <database> [file of EudraCT numbers, default: all ongoing trials]
+    start_time = time.time()
+    print("Executing")
+    if len(sys.argv) > 2 and sys.argv[1] == "refresh":
+        if len(sys.argv) > 3:
+            trials_to_refresh = read_trial_list(sys.argv[3])
+        else:
+            trials_to_refresh = ongoing_trials(sys.argv[2])
+        print("Refreshing {} trials".format(len(trials_to_refresh)))
+        refresh(trials_to_refresh, sys.argv[2], time.strftime("%Y%m%d-%H%M") + "-refresh")
+    else:
+        crawl(time.strftime("%Y%m%d-%H%M"))
+    print("Done. Elapsed time {0:.2f} minutes.".format((time.time() - start_time) / 60))